@@ -1,7 +1,7 @@
 from torch_spex.spherical_expansions import VectorExpansion
-from torch_spex.structures import InMemoryDataset, TransformerNeighborList, TransformerProperty, collate_nl
+from torch_spex.structures import InMemoryDataset, BatchedInMemoryDataset, TransformerNeighborList, TransformerProperty, collate_nl
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 
 import equistore
 
@@ -22,7 +22,42 @@ def test_in_memory_neighbor_list():
     dataset = InMemoryDataset(frames, transformers)
     loader = DataLoader(dataset, batch_size=n_structures, collate_fn=collate_nl)
     batch = next(iter(loader))
-    assert set(batch.keys()) == {'positions', 'species', 'cell', 'centers', 'pairs', 'cell_shifts', 'structure_centers', 'structure_pairs', 'direction_vectors','energy', 'forces'}
+    assert set(batch.keys()) == {'positions', 'species', 'cell', 'centers', 'pairs', 'cell_shifts', 'structure_centers', 'structure_pairs', 'direction_vectors', 'species_center_per_pair', 'species_neighbor_per_pair', 'pairs_offset', 'energy', 'forces'}
     assert len(batch['species']) == len(batch['centers']) == len(batch['structure_centers']) == len(batch['forces'])
     assert len(batch['positions']) == len(batch['cell']) == n_structures == len(batch['energy'])
     assert len(batch['pairs']) == len(batch['cell_shifts']) == len(batch['structure_pairs']) == len(batch['direction_vectors'])
+    assert len(batch['pairs']) == len(batch['species_center_per_pair']) == len(batch['species_neighbor_per_pair']) == len(batch['pairs_offset'])
+    # the offsets shift the pairs of each structure to the atom indices of the batch
+    assert torch.equal(batch['species'][batch['pairs'][:, 0] + batch['pairs_offset']], batch['species_center_per_pair'])
+    assert torch.equal(batch['species'][batch['pairs'][:, 1] + batch['pairs_offset']], batch['species_neighbor_per_pair'])
+
+def test_batched_in_memory_dataset():
+
+    n_structures = 3
+    frames = ase.io.read('datasets/rmd17/ethanol1.extxyz', f':{n_structures}')
+    def get_transformers():
+        return [TransformerNeighborList(cutoff=3.),
+                TransformerProperty("energy", lambda frame: torch.tensor([frame.get_total_energy()])),
+                TransformerProperty("forces", lambda frame: torch.tensor(frame.get_forces()))]
+
+    dataset = InMemoryDataset(frames, get_transformers())
+    loader = DataLoader(dataset, batch_size=2, collate_fn=collate_nl)
+
+    batched_dataset = BatchedInMemoryDataset(frames, get_transformers())
+    sampler = BatchSampler(SequentialSampler(batched_dataset), batch_size=2, drop_last=False)
+    batched_loader = DataLoader(batched_dataset, sampler=sampler, batch_size=None, collate_fn=lambda batch: batch)
+
+    assert len(batched_dataset) == n_structures
+    for batch, batched_batch in zip(loader, batched_loader):
+        assert set(batch.keys()) == set(batched_batch.keys())
+        for key in ["positions", "cell"]:
+            assert len(batch[key]) == len(batched_batch[key])
+            for value, batched_value in zip(batch[key], batched_batch[key]):
+                assert torch.equal(value, batched_value)
+        for key in filter(lambda x : x not in ["positions", "cell"], batch.keys()):
+            assert torch.equal(batch[key], batched_batch[key])
+
+    # the batches must not share an autograd graph, otherwise the backward pass
+    # of one batch frees the saved tensors needed by the next one
+    for batched_batch in batched_loader:
+        batched_batch["direction_vectors"].sum().backward()
@@ -14,6 +14,33 @@ from torch_spex.structures import InMemoryDataset, TransformerNeighborList, coll
 from torch.utils.data import DataLoader
 from equistore import TensorMap, TensorBlock, Labels
 
+def has_inductor():
+    try:
+        import torch._dynamo
+        import torch._inductor
+        if not getattr(torch._dynamo, "is_dynamo_supported", lambda: True)():
+            return False
+        # inductor on the CPU also needs a working C++ compiler, which is
+        # only found out by compiling something
+        torch.compile(lambda x: x + 1, dynamic=True)(torch.ones(2))
+    except Exception:
+        return False
+    return True
+
+def assert_bfloat16_close(tm_ref, tm):
+    # bfloat16 has a relative precision of 2**-8 ~ 4e-3, and the error adds up
+    # over the radial and angular channels of the einsum and over the neighbors
+    # summed into each density. This gives errors of 1-2% of the largest value
+    # of a block, so each block is compared with an absolute tolerance of 5%
+    # of its largest reference value.
+    for key, block_ref in tm_ref.items():
+        block = tm.block(**{name: int(value) for name, value in zip(tm_ref.keys.names, key)})
+        assert block.values.dtype == torch.bfloat16
+        values_ref = torch.as_tensor(block_ref.values)
+        values = block.values.to(values_ref.dtype)
+        atol = 5e-2 * values_ref.abs().max().item()
+        assert torch.allclose(values_ref, values, atol=atol, rtol=0)
+
 class TestEthanol1SphericalExpansion:
     """
     Tests on the ethanol1 dataset
@@ -76,6 +103,35 @@ class TestEthanol1SphericalExpansion:
         # now we using float64 computation the accuracy had to be decreased again
         assert equistore.operations.allclose(tm_ref, tm, atol=1e-5, rtol=1e-5)
 
+    def test_spherical_expansion_unknown_species(self):
+        # carbon is missing from all_species
+        spherical_expansion_calculator = SphericalExpansion(self.hypers, [1, 8], device=self.device)
+        with torch.no_grad():
+            with pytest.raises(ValueError, match=r"\[6\]"):
+                spherical_expansion_calculator.forward(**self.batch)
+
+    def test_spherical_expansion_coeffs_bfloat16(self):
+        tm_ref = equistore.core.io.load_custom_array("tests/data/spherical_expansion_coeffs-ethanol1_0-data.npz", equistore.core.io.create_torch_array)
+        spherical_expansion_calculator = SphericalExpansion(self.hypers, self.all_species, device=self.device, dtype=torch.bfloat16)
+        with torch.no_grad():
+            tm = spherical_expansion_calculator.forward(**self.batch)
+        assert_bfloat16_close(tm_ref, tm)
+
+    def test_spherical_expansion_coeffs_alchemical_bfloat16(self):
+        with open("tests/data/expansion_coeffs-ethanol1_0-alchemical-hypers.json", "r") as f:
+            hypers = json.load(f)
+        tm_ref = equistore.core.io.load_custom_array("tests/data/spherical_expansion_coeffs-ethanol1_0-alchemical-seed0-data.npz", equistore.core.io.create_torch_array)
+        torch.manual_seed(0)
+        spherical_expansion_calculator = SphericalExpansion(hypers, self.all_species, device=self.device, dtype=torch.bfloat16)
+        with torch.no_grad():
+            spherical_expansion_calculator.vector_expansion_calculator.radial_basis_calculator.combination_matrix.weight.copy_(torch.tensor(
+                    [[-0.00432252,  0.30971584, -0.47518533],
+                     [-0.4248946 , -0.22236897,  0.15482073]], dtype=torch.float32))
+
+        with torch.no_grad():
+            tm = spherical_expansion_calculator.forward(**self.batch)
+        assert_bfloat16_close(tm_ref, tm)
+
 class TestArtificialSphericalExpansion:
     """
     Tests on the artificial dataset
@@ -101,6 +157,21 @@ class TestArtificialSphericalExpansion:
             tm = sort_tm(vector_expansion.forward(**self.batch))
         assert equistore.operations.allclose(tm_ref, tm, atol=1e-5, rtol=1e-5)
 
+    @pytest.mark.skipif(not has_inductor(), reason="torch.compile with inductor is not available")
+    def test_vector_expansion_coeffs_compiled(self):
+        vector_expansion = VectorExpansion(self.hypers, self.all_species, device=self.device)
+        compiled_vector_expansion = VectorExpansion(self.hypers, self.all_species, device=self.device, compiled=True)
+        # one structure and all structures give batches with different numbers
+        # of pairs, which the dynamic shapes of the compiled function must handle
+        single_batch = next(iter(DataLoader(self.dataset, batch_size=1, collate_fn=collate_nl)))
+        single_batch.pop("positions")
+        single_batch.pop("cell")
+        for batch in [single_batch, self.batch]:
+            with torch.no_grad():
+                tm = vector_expansion.forward(**batch)
+                tm_compiled = compiled_vector_expansion.forward(**batch)
+            assert equistore.operations.allclose(tm, tm_compiled, atol=1e-6, rtol=1e-6)
+
     def test_spherical_expansion_coeffs(self):
         tm_ref = equistore.core.io.load_custom_array("tests/data/spherical_expansion_coeffs-artificial-data.npz", equistore.core.io.create_torch_array)
         spherical_expansion_calculator = SphericalExpansion(self.hypers, self.all_species, device=self.device)
@@ -110,6 +181,35 @@ class TestArtificialSphericalExpansion:
         # I presume it is because we use 5 frames instead of just one
         assert equistore.operations.allclose(tm_ref, tm, atol=3e-5, rtol=1e-5)
 
+    def test_spherical_expansion_forward_batched(self):
+        spherical_expansion_calculator = SphericalExpansion(self.hypers, self.all_species, device=self.device)
+        transformers = [TransformerNeighborList(cutoff=self.hypers["cutoff radius"])]
+        dataset = InMemoryDataset(self.frames, transformers)
+        loader = DataLoader(dataset, batch_size=1, collate_fn=collate_nl)
+        inputs = []
+        for batch in loader:
+            batch.pop("positions")
+            batch.pop("cell")
+            inputs.append(batch)
+        with torch.no_grad():
+            tms = spherical_expansion_calculator.forward_batched(inputs)
+            tms_ref = [spherical_expansion_calculator.forward(**batch) for batch in inputs]
+        assert len(tms) == len(tms_ref)
+        for tm, tm_ref in zip(tms, tms_ref):
+            assert equistore.operations.allclose(tm_ref, tm, atol=1e-10, rtol=1e-10)
+
+    def test_spherical_expansion_forward_batched_empty(self):
+        spherical_expansion_calculator = SphericalExpansion(self.hypers, self.all_species, device=self.device)
+        # an input without atoms gives empty blocks and does not shift the others
+        empty_input = {key: value[:0] for key, value in self.batch.items()}
+        with torch.no_grad():
+            assert spherical_expansion_calculator.forward_batched([]) == []
+            tm_empty, tm = spherical_expansion_calculator.forward_batched([empty_input, self.batch])
+            tm_ref = spherical_expansion_calculator.forward(**self.batch)
+        for _, block in tm_empty.items():
+            assert len(block.samples) == 0
+        assert equistore.operations.allclose(tm_ref, tm, atol=1e-10, rtol=1e-10)
+
     def test_spherical_expansion_coeffs_artificial(self):
         with open("tests/data/expansion_coeffs-artificial-alchemical-hypers.json", "r") as f:
             hypers = json.load(f)
@@ -9,7 +9,7 @@ from equistore import TensorMap, Labels, TensorBlock
 import sphericart.torch
 
 from .radial_basis import RadialBasis
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 class SphericalExpansion(torch.nn.Module):
     """
@@ -42,6 +42,14 @@ class SphericalExpansion(torch.nn.Module):
         - **radial basis**: smooth basis optimizing Rayleight quotients [lle]_
           - **E_max** energy cutoff for the eigenvalues of the eigenstates
         - **alchemical**: number of pseudo species to reduce the species channels to
+    :param compiled:
+        wraps :py:func:`compute_vector_expansion` in
+        ``torch.compile(dynamic=True)``. The first calls are slow, because the
+        kernels are compiled for the shapes of the inputs.
+    :param dtype:
+        dtype of the products of the radial basis and the spherical harmonics,
+        e.g. torch.bfloat16. The values of the returned blocks are then in this
+        dtype. By default the dtype of the inputs is kept.
 
     .. [lle]
         Bigi, Filippo, et al. "A smooth basis for atomistic machine learning."
@@ -78,12 +86,25 @@ class SphericalExpansion(torch.nn.Module):
 
     """
 
-    def __init__(self, hypers: Dict, all_species: List[int], device: str ="cpu") -> None:
+    def __init__(self, hypers: Dict, all_species: List[int], device: str ="cpu", compiled: bool = False, dtype: Optional[torch.dtype] = None) -> None:
         super().__init__()
 
         self.hypers = hypers
         self.all_species = np.array(all_species, dtype=np.int32)  # convert potential list to np.array
-        self.vector_expansion_calculator = VectorExpansion(hypers, self.all_species, device=device)
+        self.vector_expansion_calculator = VectorExpansion(hypers, self.all_species, device=device, compiled=compiled, dtype=dtype)
+        # sorted species and the permutation back to the order in all_species
+        # allow a vectorized lookup of the species index with bucketize on
+        # the device, they are buffers so they follow the module with .to()
+        self.register_buffer(
+            "_sorted_species",
+            torch.tensor(np.sort(self.all_species), dtype=torch.long, device=device),
+            persistent=False
+        )
+        self.register_buffer(
+            "_sorted_perm",
+            torch.tensor(np.argsort(self.all_species), dtype=torch.long, device=device),
+            persistent=False
+        )
 
         if "alchemical" in self.hypers:
             self.is_alchemical = True
@@ -91,6 +112,43 @@ class SphericalExpansion(torch.nn.Module):
         else:
             self.is_alchemical = False
 
+        # the metadata of the blocks only depends on the hypers and the species,
+        # so it is built once here and reused in every forward call
+        if self.is_alchemical:
+            unique_species = -np.arange(self.n_pseudo_species)
+        else:
+            unique_species = self.all_species
+        # the number of radial channels for each l is set by the radial basis
+        self._n_max_per_l = [int(n_max) for n_max in self.vector_expansion_calculator.radial_basis_calculator.n_max_l]
+        # number of values of each l per pair, used to split the fused densities
+        n_neighbor_channels = self.n_pseudo_species if self.is_alchemical else 1
+        self._split_sizes = [(2*l+1)*n_neighbor_channels*n_max for l, n_max in enumerate(self._n_max_per_l)]
+        self._per_l_components = []
+        self._per_l_properties = []
+        for l in range(self.vector_expansion_calculator.l_max+1):
+            # the columns (a1, n1, l1) are written directly into one int32 buffer
+            # instead of stacking repeated and tiled temporary arrays
+            n_max = self._n_max_per_l[l]
+            properties_values = np.empty((unique_species.shape[0]*n_max, 3), dtype=np.int32)
+            properties_values[:, 0].reshape(unique_species.shape[0], n_max)[:] = unique_species[:, None]
+            properties_values[:, 1].reshape(unique_species.shape[0], n_max)[:] = np.arange(n_max)[None, :]
+            properties_values[:, 2] = l
+            self._per_l_components.append(self.vector_expansion_calculator._m_components[l])
+            self._per_l_properties.append(
+                Labels(
+                    names = ["a1", "n1", "l1"],
+                    values = properties_values
+                )
+            )
+        # the keys are in the same order as the blocks are built in forward
+        self._tmap_keys = Labels(
+            names = ["a_i", "lam", "sigma"],
+            values = np.array(
+                [[a_i, l, 1] for l in range(self.vector_expansion_calculator.l_max+1) for a_i in self.all_species],
+                dtype=np.int32
+            )
+        )
+
     def forward(self,
             species: torch.Tensor,
             cell_shifts: torch.Tensor,
@@ -98,7 +156,10 @@ class SphericalExpansion(torch.nn.Module):
             pairs: torch.Tensor,
             structure_centers: torch.Tensor,
             structure_pairs: torch.Tensor,
-            direction_vectors: torch.Tensor
+            direction_vectors: torch.Tensor,
+            species_center_per_pair: torch.Tensor,
+            species_neighbor_per_pair: torch.Tensor,
+            pairs_offset: torch.Tensor
         ) -> TensorMap:
         """
         We use `n_atoms` to describe the number of all atoms over all structures
@@ -122,6 +183,13 @@ class SphericalExpansion(torch.nn.Module):
                 corresponding structure for each center neighbor pair
         :param direction_vectors: [n_pairs, 3] tensor of floats with the periodic
                 boundary condiiions in xyz direction
+        :param species_center_per_pair: [n_pairs] tensor of integers with the
+                atomic species of the center of each pair
+        :param species_neighbor_per_pair: [n_pairs] tensor of integers with the
+                atomic species of the neighbor of each pair
+        :param pairs_offset: [n_pairs] tensor of integers with the index of the
+                first atom of the corresponding structure in the batch for each
+                center neighbor pair, as computed by collate_nl
 
         :returns expansion_coeffs:
             the spherical expansion coefficients
@@ -129,105 +197,189 @@ class SphericalExpansion(torch.nn.Module):
         """
 
         expanded_vectors = self.vector_expansion_calculator(
-                species, cell_shifts, centers, pairs, structure_centers, structure_pairs, direction_vectors)
-
-        samples_metadata = expanded_vectors.block(l=0).samples
+                species, cell_shifts, centers, pairs, structure_centers, structure_pairs, direction_vectors,
+                species_center_per_pair, species_neighbor_per_pair, pairs_offset)
 
         s_metadata = torch.LongTensor(structure_centers.clone())  # Copy to suppress torch warning about non-writeability
         i_metadata = torch.LongTensor(centers.clone())
 
         n_species = len(self.all_species)
-        species_to_index = {atomic_number : i_species for i_species, atomic_number in enumerate(self.all_species)}
 
         unique_s_i_indices = torch.stack((structure_centers, centers), dim=1)
 
-        _, centers_count_per_structure = torch.unique(
-                structure_centers, return_counts=True)
-        _, inverse_idx = torch.unique(
-                structure_pairs, return_inverse=True)
-        centers_offsets_per_structure = torch.hstack((torch.tensor([0]), centers_count_per_structure[:-1])).cumsum(0)
-        pairs_offset = centers_offsets_per_structure[inverse_idx]
-        s_i_metadata_to_unique  = pairs[:, 0] + pairs_offset
+        # a stable sort by species groups the centers of each species into a
+        # contiguous slice, keeping their original order within the species.
+        # The densities are accumulated directly in this sorted order, so no
+        # extra copy is needed to gather the centers of each species
+        species_sort_idx = torch.argsort(species, stable=True)
+        species_counts = torch.bincount(species, minlength=int(self.all_species.max())+1)
+        species_offsets = (species_counts.cumsum(0) - species_counts).tolist()
+        species_counts = species_counts.tolist()
+        sorted_s_i_indices = unique_s_i_indices[species_sort_idx].numpy()
+
+        center_to_sorted = torch.empty_like(species_sort_idx)
+        center_to_sorted[species_sort_idx] = torch.arange(len(species_sort_idx))
+
+        s_i_metadata_to_unique  = center_to_sorted[pairs[:, 0] + pairs_offset]
 
         l_max = self.vector_expansion_calculator.l_max
         n_centers = len(centers)  # total number of atoms in this batch of structures
 
-        densities = []
+        # the density indices are computed on the device of the module, the
+        # integer metadata only needs a host to device copy
+        device = self._sorted_species.device
         if self.is_alchemical:
-            density_indices = torch.LongTensor(s_i_metadata_to_unique)
-            for l in range(l_max+1):
-                expanded_vectors_l = expanded_vectors.block(l=l).values
-                densities_l = torch.zeros(
-                    (n_centers, expanded_vectors_l.shape[1], expanded_vectors_l.shape[2]),
-                    dtype = expanded_vectors_l.dtype,
-                    device = expanded_vectors_l.device
-                )
-                densities_l.index_add_(dim=0, index=density_indices.to(expanded_vectors_l.device), source=expanded_vectors_l)
-                densities_l = densities_l.reshape((n_centers, 2*l+1, -1))
-                densities.append(densities_l)
-            unique_species = -np.arange(self.n_pseudo_species)
+            density_indices = s_i_metadata_to_unique.to(device)
+            n_densities = n_centers
         else:
-            aj_metadata = samples_metadata["species_neighbor"]
-            aj_shifts = np.array([species_to_index[aj_index] for aj_index in aj_metadata])
-            density_indices = torch.LongTensor(s_i_metadata_to_unique*n_species+aj_shifts)
-
-            for l in range(l_max+1):
-                expanded_vectors_l = expanded_vectors.block(l=l).values
-                densities_l = torch.zeros(
-                    (n_centers*n_species, expanded_vectors_l.shape[1], expanded_vectors_l.shape[2]),
-                    dtype = expanded_vectors_l.dtype,
-                    device = expanded_vectors_l.device
+            species_neighbor_per_pair = species_neighbor_per_pair.to(device)
+            sorted_idx = torch.bucketize(species_neighbor_per_pair, self._sorted_species)
+            # bucketize maps a species that is not in all_species to the next
+            # larger one, so unknown species have to be caught explicitly
+            is_known_species = self._sorted_species[sorted_idx.clamp(max=n_species-1)] == species_neighbor_per_pair
+            if not torch.all(is_known_species):
+                unknown_species = torch.unique(species_neighbor_per_pair[~is_known_species]).tolist()
+                raise ValueError(
+                    f"Neighbor species {unknown_species} are not in all_species {self.all_species.tolist()}"
                 )
-                densities_l.index_add_(dim=0, index=density_indices.to(expanded_vectors_l.device), source=expanded_vectors_l)
+            aj_shifts = self._sorted_perm[sorted_idx]
+            density_indices = s_i_metadata_to_unique.to(device)*n_species + aj_shifts
+            n_densities = n_centers*n_species
+
+        # the blocks of all l are flattened and concatenated along the properties
+        # so that the densities are accumulated with a single index_add_
+        expanded_vectors_values = [expanded_vectors.block(l=l).values for l in range(l_max+1)]
+        flat_expanded_vectors = torch.cat(
+            [values_l.flatten(start_dim=1) for values_l in expanded_vectors_values], dim=1)
+        flat_densities = torch.zeros(
+            (n_densities, flat_expanded_vectors.shape[1]),
+            dtype = flat_expanded_vectors.dtype,
+            device = flat_expanded_vectors.device
+        )
+        flat_densities.index_add_(dim=0, index=density_indices.to(flat_expanded_vectors.device), source=flat_expanded_vectors)
+
+        densities = []
+        for l, densities_l in enumerate(torch.split(flat_densities, self._split_sizes, dim=1)):
+            if self.is_alchemical:
+                densities_l = densities_l.reshape((n_centers, 2*l+1, -1))
+            else:
                 densities_l = densities_l.reshape((n_centers, n_species, 2*l+1, -1)).swapaxes(1, 2).reshape((n_centers, 2*l+1, -1))  # need to swap n, a indices which are in the wrong order
-                densities.append(densities_l)
-            unique_species = self.all_species
+            densities.append(densities_l)
+
+        # the samples only depend on the central species, so their Labels are
+        # built once per species and shared by the blocks of all l
+        species_slices = [
+            slice(species_offsets[a_i], species_offsets[a_i] + species_counts[a_i])
+            for a_i in self.all_species
+        ]
+        species_samples = [
+            Labels(
+                names = ["structure", "center"],
+                values = sorted_s_i_indices[ai_slice]
+            )
+            for ai_slice in species_slices
+        ]
 
         # constructs the TensorMap object
-        ai_new_indices = species
-        labels = []
-        blocks = []
-        for l in range(l_max+1):
-            densities_l = densities[l]
-            vectors_l_block = expanded_vectors.block(l=l)
-            vectors_l_block_components = vectors_l_block.components
-            vectors_l_block_n = np.arange(len(np.unique(vectors_l_block.properties["n"])))  # Need to be smarter to optimize
-            for a_i in self.all_species:
-                where_ai = torch.LongTensor(np.where(ai_new_indices == a_i)[0]).to(densities_l.device)
-                densities_ai_l = torch.index_select(densities_l, 0, where_ai)
-                labels.append([a_i, l, 1])
-                blocks.append(
-                    TensorBlock(
-                        values = densities_ai_l,
-                        samples = Labels(
-                            names = ["structure", "center"],
-                            values = unique_s_i_indices.numpy()[where_ai.cpu().numpy()]
-                        ),
-                        components = vectors_l_block_components,
-                        properties = Labels(
-                            names = ["a1", "n1", "l1"],
-                            values = np.stack(
-                                [
-                                    np.repeat(unique_species, vectors_l_block_n.shape[0]),
-                                    np.tile(vectors_l_block_n, unique_species.shape[0]),
-                                    l*np.ones((densities_ai_l.shape[2],), dtype=np.int32)
-                                ],
-                                axis=1
-                            )
-                        )
-                    )
-                )
+        blocks = [
+            TensorBlock(
+                values = densities[l][ai_slice],
+                samples = samples_ai,
+                components = self._per_l_components[l],
+                properties = self._per_l_properties[l]
+            )
+            for l in range(l_max+1)
+            for ai_slice, samples_ai in zip(species_slices, species_samples)
+        ]
 
         spherical_expansion = TensorMap(
-            keys = Labels(
-                names = ["a_i", "lam", "sigma"],
-                values = np.array(labels, dtype=np.int32)
-            ),
+            keys = self._tmap_keys,
             blocks = blocks
         )
 
         return spherical_expansion
 
+    def forward_batched(self, inputs: List[Dict[str, torch.Tensor]]) -> List[TensorMap]:
+        """
+        Computes the spherical expansions of several inputs with a single call
+        of :py:meth:`forward`, so the spherical harmonics and the densities of
+        all inputs are computed in one go. This amortizes the per-call overhead
+        when each input is small, e.g. a single structure in a molecular
+        dynamics step.
+
+        :param inputs: list of the keyword arguments of :py:meth:`forward` for
+                each input, as produced by collate_nl without positions and cell.
+                The structure indices of each input are assumed to start at zero.
+                An input without atoms gives a TensorMap with empty blocks.
+
+        :returns expansion_coeffs:
+            list with the spherical expansion coefficients of each input
+        """
+        if len(inputs) == 0:
+            return []
+
+        # the structure indices and the pair offsets of each input are shifted
+        # behind the ones of the previous inputs, all other indices are local
+        # to a structure
+        n_structures = [
+            int(input_kwargs["structure_centers"].max()) + 1 if len(input_kwargs["structure_centers"]) > 0 else 0
+            for input_kwargs in inputs
+        ]
+        structure_offsets = np.cumsum([0] + n_structures)
+        centers_offsets = np.cumsum([0] + [len(input_kwargs["centers"]) for input_kwargs in inputs])
+        merged_kwargs = {}
+        for key in inputs[0].keys():
+            values = [input_kwargs[key] for input_kwargs in inputs]
+            if key in ["structure_centers", "structure_pairs"]:
+                values = [value + offset for value, offset in zip(values, structure_offsets)]
+            elif key == "pairs_offset":
+                values = [value + offset for value, offset in zip(values, centers_offsets)]
+            merged_kwargs[key] = torch.concatenate(values, dim=0)
+
+        spherical_expansion = self.forward(**merged_kwargs)
+
+        # the samples of each block are ordered by structure, so the samples
+        # of each input form a contiguous slice. The samples only depend on the
+        # central species, so the slices and their Labels are built once per
+        # species from the l=0 blocks and shared by the blocks of all l, the
+        # blocks are ordered with l outer and a_i inner as in forward
+        blocks = [block for _, block in spherical_expansion.items()]
+        n_species = len(self.all_species)
+        input_slices = []
+        input_samples = []
+        for block in blocks[:n_species]:
+            samples_values = block.samples.values
+            bounds = np.searchsorted(block.samples["structure"], structure_offsets)
+            input_slices.append([])
+            input_samples.append([])
+            for i_input in range(len(inputs)):
+                input_slice = slice(bounds[i_input], bounds[i_input+1])
+                input_samples_values = samples_values[input_slice].copy()
+                input_samples_values[:, 0] -= structure_offsets[i_input]
+                input_slices[-1].append(input_slice)
+                input_samples[-1].append(
+                    Labels(
+                        names = block.samples.names,
+                        values = input_samples_values
+                    )
+                )
+
+        return [
+            TensorMap(
+                keys = spherical_expansion.keys,
+                blocks = [
+                    TensorBlock(
+                        values = block.values[input_slices[i_block % n_species][i_input]],
+                        samples = input_samples[i_block % n_species][i_input],
+                        components = block.components,
+                        properties = block.properties
+                    )
+                    for i_block, block in enumerate(blocks)
+                ]
+            )
+            for i_input in range(len(inputs))
+        ]
+
 
 class VectorExpansion(torch.nn.Module):
     """
@@ -254,12 +406,25 @@ class VectorExpansion(torch.nn.Module):
 
          c^{keys}_{samples, components, properties}
 
+    :param hypers: see :py:class:`SphericalExpansion`
+    :param compiled:
+        wraps :py:func:`compute_vector_expansion` in
+        ``torch.compile(dynamic=True)``. The first calls are slow, because the
+        kernels are compiled for the shapes of the inputs.
+    :param dtype:
+        dtype of the products of the radial basis and the spherical harmonics,
+        e.g. torch.bfloat16. The values of the returned blocks are then in this
+        dtype. By default the dtype of the inputs is kept.
     """
 
-    def __init__(self, hypers: Dict, all_species, device: str = "cpu") -> None:
+    def __init__(self, hypers: Dict, all_species, device: str = "cpu", compiled: bool = False, dtype: Optional[torch.dtype] = None) -> None:
         super().__init__()
 
         self.hypers = hypers
+        # dtype of the products of the radial basis and the spherical harmonics,
+        # e.g. torch.bfloat16 to halve the memory traffic, the distances and
+        # the basis functions themselves are still computed in the input dtype
+        self.dtype = dtype
         # radial basis needs to know cutoff so we pass it
         hypers_radial_basis = copy.deepcopy(hypers["radial basis"])
         hypers_radial_basis["r_cut"] = hypers["cutoff radius"]
@@ -272,7 +437,43 @@ class VectorExpansion(torch.nn.Module):
         self.radial_basis_calculator = RadialBasis(hypers_radial_basis, all_species, device=device)
         self.l_max = self.radial_basis_calculator.l_max
         self.spherical_harmonics_calculator = sphericart.torch.SphericalHarmonics(self.l_max, normalized=True)
-        self.spherical_harmonics_split_list = [(2*l+1) for l in range(self.l_max+1)]
+        # torch.compile fuses the per-l products into fewer kernels, but the
+        # compilation on the first calls is expensive, so it is opt-in
+        if compiled:
+            self._compute_vector_expansion = torch.compile(compute_vector_expansion, dynamic=True)
+        else:
+            self._compute_vector_expansion = compute_vector_expansion
+
+        # the metadata of the blocks only depends on the hypers, so it is
+        # built once here and reused in every forward call
+        self._m_components = []
+        self._vector_properties = []
+        for l in range(self.l_max+1):
+            n_max_l = int(self.radial_basis_calculator.n_max_l[l])
+            self._m_components.append([
+                Labels(
+                    names = ("m",),
+                    values = np.arange(-l, l+1, dtype=np.int32).reshape(2*l+1, 1)
+                )
+            ])
+            if self.is_alchemical:
+                properties = Labels(
+                    names = ["alpha_j", "n"],
+                    values = np.stack(
+                        [
+                            np.repeat(-np.arange(self.n_pseudo_species), n_max_l),
+                            np.tile(np.arange(n_max_l), self.n_pseudo_species)
+                        ],
+                        axis=1
+                    )
+                )
+            else:
+                properties = Labels.range("n", n_max_l)
+            self._vector_properties.append(properties)
+        self._tmap_keys = Labels(
+            names = ("l",),
+            values = np.arange(0, self.l_max+1, dtype=np.int32).reshape(self.l_max+1, 1),
+        )
 
     def forward(self,
             species: torch.Tensor,
@@ -281,7 +482,10 @@ class VectorExpansion(torch.nn.Module):
             pairs: torch.Tensor,
             structure_centers: torch.Tensor,
             structure_pairs: torch.Tensor,
-            direction_vectors: torch.Tensor
+            direction_vectors: torch.Tensor,
+            species_center_per_pair: torch.Tensor,
+            species_neighbor_per_pair: torch.Tensor,
+            pairs_offset: torch.Tensor
         ) -> TensorMap:
         """
         We use `n_atoms` to describe the number of all atoms over all structures
@@ -305,105 +509,110 @@ class VectorExpansion(torch.nn.Module):
                 corresponding structure for each center neighbor pair
         :param direction_vectors: [n_pairs, 3] tensor of floats with the periodic
                 boundary condiiions in xyz direction
+        :param species_center_per_pair: [n_pairs] tensor of integers with the
+                atomic species of the center of each pair
+        :param species_neighbor_per_pair: [n_pairs] tensor of integers with the
+                atomic species of the neighbor of each pair
+        :param pairs_offset: [n_pairs] tensor of integers with the index of the
+                first atom of the corresponding structure in the batch for each
+                center neighbor pair, as computed by collate_nl
+
+        `species`, `centers`, `structure_centers` and `pairs_offset` are not used
+        by the vector expansion. They are accepted only so that the same
+        `**batch` can be passed as to SphericalExpansion.forward.
 
         :returns pair_expansion_coeffs:
             the spherical expansion coefficients for each neighbour
             :math:`c^{l}_{Aija_ia_j,m,n}`
         """
 
-        cartesian_vectors = get_cartesian_vectors(species, cell_shifts, centers, pairs, structure_centers, structure_pairs, direction_vectors)
+        cartesian_vectors = get_cartesian_vectors(cell_shifts, pairs, structure_pairs, direction_vectors,
+                species_center_per_pair, species_neighbor_per_pair)
 
         bare_cartesian_vectors = cartesian_vectors.values.squeeze(dim=-1)
-        r = torch.sqrt(
-            (bare_cartesian_vectors**2)
-            .sum(dim=-1)
-        )
+        r = torch.linalg.vector_norm(bare_cartesian_vectors, dim=-1)
         samples_metadata = cartesian_vectors.samples  # This can be needed by the radial basis to do alchemical contractions
         radial_basis = self.radial_basis_calculator(r, samples_metadata)
 
         spherical_harmonics = self.spherical_harmonics_calculator.compute(bare_cartesian_vectors)  # Get the spherical harmonics
-        spherical_harmonics = torch.split(spherical_harmonics, self.spherical_harmonics_split_list, dim=1)  # Split them into l chunks
 
-        # Use broadcasting semantics to get the products in equistore shape
+        if self.dtype is not None:
+            radial_basis = [radial_basis_l.to(dtype=self.dtype) for radial_basis_l in radial_basis]
+            spherical_harmonics = spherical_harmonics.to(dtype=self.dtype)
+
+        vector_expansion = self._compute_vector_expansion(radial_basis, spherical_harmonics, self.is_alchemical)
         vector_expansion_blocks = []
-        for l, (radial_basis_l, spherical_harmonics_l) in enumerate(zip(radial_basis, spherical_harmonics)):
-            if self.is_alchemical:  # If the model is alchemical, the radial basis has one extra dimension (alpha_j)
-                vector_expansion_l = radial_basis_l[:, None, :, :] * spherical_harmonics_l[:, :, None, None]
-                n_max_l = vector_expansion_l.shape[3]
-            else:
-                vector_expansion_l = radial_basis_l[:, None, :] * spherical_harmonics_l[:, :, None]
-                n_max_l = vector_expansion_l.shape[2]
-            if self.is_alchemical:
-                properties = Labels(
-                    names = ["alpha_j", "n"],
-                    values = np.stack(
-                        [
-                            np.repeat(-np.arange(self.n_pseudo_species), n_max_l),
-                            np.tile(np.arange(n_max_l), self.n_pseudo_species)
-                        ],
-                        axis=1
-                    )
-                )
-            else:
-                properties = Labels.range("n", n_max_l)
+        for l, vector_expansion_l in enumerate(vector_expansion):
             vector_expansion_blocks.append(
                 TensorBlock(
-                    values = vector_expansion_l.reshape(vector_expansion_l.shape[0], 2*l+1, -1),
+                    values = vector_expansion_l,
                     samples = cartesian_vectors.samples,
-                    components = [Labels(
-                        names = ("m",),
-                        values = np.arange(-l, l+1, dtype=np.int32).reshape(2*l+1, 1)
-                    )],
-                    properties = properties
+                    components = self._m_components[l],
+                    properties = self._vector_properties[l]
                 )
             )
 
-        l_max = len(vector_expansion_blocks) - 1
         vector_expansion_tmap = TensorMap(
-            keys = Labels(
-                names = ("l",),
-                values = np.arange(0, l_max+1, dtype=np.int32).reshape(l_max+1, 1),
-            ),
+            keys = self._tmap_keys,
             blocks = vector_expansion_blocks
         )
 
         return vector_expansion_tmap
 
+def compute_vector_expansion(
+        radial_basis: List[torch.Tensor],
+        spherical_harmonics: torch.Tensor,
+        is_alchemical: bool
+    ) -> List[torch.Tensor]:
+    """
+    Computes the values of the vector expansion for each l as the outer
+    product of the radial basis and the spherical harmonics of degree l.
+
+    This function only contains the tensor operations of the VectorExpansion,
+    so it can be compiled with torch.compile.
+
+    :param radial_basis: list of [n_pairs, n_max_l] tensors, or of
+            [n_pairs, n_pseudo_species, n_max_l] tensors if alchemical
+    :param spherical_harmonics: [n_pairs, (l_max+1)**2] tensor with the spherical
+            harmonics of all l, the ones of degree l are in the columns
+            l**2 to (l+1)**2
+    :param is_alchemical: whether the radial basis has a pseudo species dimension
+
+    :returns: list of [n_pairs, 2*l+1, n_properties_l] tensors
+    """
+    vector_expansion = []
+    # Use einsum to get the outer products in equistore shape
+    for l, radial_basis_l in enumerate(radial_basis):
+        # slicing the spherical harmonics instead of splitting them beforehand
+        # keeps all reads on one tensor, which the compiler can fuse
+        spherical_harmonics_l = spherical_harmonics[:, l*l:(l+1)*(l+1)]
+        if is_alchemical:  # If the model is alchemical, the radial basis has one extra dimension (alpha_j)
+            vector_expansion_l = torch.einsum("pm,pan->pman", spherical_harmonics_l, radial_basis_l)
+        else:
+            vector_expansion_l = torch.einsum("pm,pn->pmn", spherical_harmonics_l, radial_basis_l)
+        vector_expansion.append(vector_expansion_l.reshape(vector_expansion_l.shape[0], 2*l+1, -1))
+    return vector_expansion
+
 # PR COMMENT: This function will be removed as soon as we got a equistore Dataset and DataLoader
 #             see issue https://github.com/lab-cosmo/equisolve/issues/56
-def get_cartesian_vectors(species, cell_shifts, centers, pairs, structure_centers, structure_pairs, direction_vectors):
+def get_cartesian_vectors(cell_shifts, pairs, structure_pairs, direction_vectors,
+        species_center_per_pair, species_neighbor_per_pair):
     """
     Wraps direction vectors into TensorMap object with metadata information
     """
-    labels = []
-    vectors = []
-
-    _, centers_count_per_structure = torch.unique(
-            structure_centers, return_counts=True)
-    _, inverse_idx = torch.unique(
-            structure_pairs, return_inverse=True)
-    centers_offsets_per_structure = torch.hstack((torch.tensor([0]), centers_count_per_structure[:-1])).cumsum(0)
-    pairs_offset = centers_offsets_per_structure[inverse_idx]
-    shifted_pairs_idx = pairs + pairs_offset[:, None]
-
-    pairs_i = pairs[:, 0]
-    pairs_j = pairs[:, 1]
-
-    vectors.append(direction_vectors)
-    labels.append(
-        torch.stack([
-            structure_pairs,
-            pairs_i,
-            pairs_j,
-            species[shifted_pairs_idx[:,0]],
-            species[shifted_pairs_idx[:,1]],
-            cell_shifts[:, 0],
-            cell_shifts[:, 1],
-            cell_shifts[:, 2]
-        ], dim=-1).detach().numpy())
-
-    vectors = torch.cat(vectors, dim=0)
-    labels = np.concatenate(labels, axis=0)
+    # the integer metadata lives on the CPU (see TransformerNeighborList),
+    # so converting it to numpy does not synchronize with the device
+    labels = torch.stack([
+        structure_pairs,
+        pairs[:, 0],
+        pairs[:, 1],
+        species_center_per_pair,
+        species_neighbor_per_pair,
+        cell_shifts[:, 0],
+        cell_shifts[:, 1],
+        cell_shifts[:, 2]
+    ], dim=-1).numpy()
+
     block = TensorBlock(
         values = direction_vectors.unsqueeze(dim=-1),
         samples = Labels(
@@ -69,6 +69,11 @@ class TransformerProperty(TransformerBase):
 class TransformerNeighborList(TransformerBase):
     """
     Produces a neighbour list and with direction vectors from an AtomicStructure
+
+    Only the positions, the cell and the direction vectors are put on `device`.
+    The integer metadata (species, centers, pairs, cell shifts and structure
+    indices) stays on the CPU, because it is only used to build the equistore
+    Labels, so no device to host copy is needed in the forward pass.
     """
     def __init__(self, cutoff: float, positions_requires_grad=True, cell_requires_grad=True, device=None):
         self._cutoff = cutoff
@@ -81,14 +86,17 @@ class TransformerNeighborList(TransformerBase):
         self._structure_index = 0
 
     def __call__(self, structure: AtomicStructure) -> Dict[str, torch.Tensor]:
-        positions_i, species_i, cell_i, pbc_i = structure_to_torch(structure, device=self._device)
+        positions_i, species_i, cell_i, pbc_i = structure_to_torch(structure)
         centers_i, pairs_ij, cell_shifts_ij = build_neighborlist(positions_i, cell_i, pbc_i,  self._cutoff)
 
+        positions_i = positions_i.to(device=self._device)
+        cell_i = cell_i.to(device=self._device)
         positions_i.requires_grad = self._positions_requires_grad
         cell_i.requires_grad = self._cell_requires_grad
 
         # cell_shifts_ij needs to be changed to float type to do operations 
-        direction_vectors_ij = positions_i[pairs_ij[:, 1]] - positions_i[pairs_ij[:, 0]] + (cell_shifts_ij.to(dtype=cell_i.dtype) @ cell_i)
+        pairs_ij_device = pairs_ij.to(device=positions_i.device)
+        direction_vectors_ij = positions_i[pairs_ij_device[:, 1]] - positions_i[pairs_ij_device[:, 0]] + (cell_shifts_ij.to(device=cell_i.device, dtype=cell_i.dtype) @ cell_i)
 
         structure_index = self._structure_index
         self._structure_index += 1
@@ -100,9 +108,33 @@ class TransformerNeighborList(TransformerBase):
                 'centers': centers_i,
                 'pairs': pairs_ij,
                 'cell_shifts': cell_shifts_ij,
-                'direction_vectors': direction_vectors_ij}
+                'direction_vectors': direction_vectors_ij,
+                'species_center_per_pair': species_i[pairs_ij[:, 0]],
+                'species_neighbor_per_pair': species_i[pairs_ij[:, 1]]}
+
 
 
+def _transform_structures(structures: List[AtomicStructure], transformers: List[TransformerBase]) -> Dict[str, List[torch.Tensor]]:
+    """
+    Applies the transformers to each structure and collects the results of
+    all structures in one list per key
+    """
+    data = defaultdict(list)
+    for structure in structures:
+        for transformer in transformers:
+            data_i = transformer(structure)
+            for key in data_i.keys():
+                data[key].append(data_i[key])
+    return data
+
+def _rebase_structure_indices(batch: Dict[str, torch.Tensor]) -> None:
+    """
+    Shifts the structure indices of a batch in place, so that they start at
+    zero for the first structure of the batch
+    """
+    min_structure_idx = batch['structure_centers'][0].clone()
+    batch['structure_centers'] -= min_structure_idx # minimum structure index should be first one
+    batch['structure_pairs'] -= min_structure_idx # minimum structure index should be first one
 
 # Temporary Dataset until we have an equistore Dataset
 class InMemoryDataset(torch.utils.data.Dataset):
@@ -111,12 +143,7 @@ class InMemoryDataset(torch.utils.data.Dataset):
                  transformers : List[TransformerBase]):
         super().__init__()
         self.n_structures = len(structures)
-        self._data = defaultdict(list)
-        for structure in structures:
-            for transformer in transformers:
-                data_i = transformer(structure)
-                for key in data_i.keys():
-                    self._data[key].append(data_i[key])
+        self._data = _transform_structures(structures, transformers)
 
     def __getitem__(self, idx):
         return {key: self._data[key][idx] for key in self._data.keys()}
@@ -124,7 +151,102 @@ class InMemoryDataset(torch.utils.data.Dataset):
     def __len__(self):
         return self.n_structures
 
+class BatchedInMemoryDataset(torch.utils.data.Dataset):
+    """
+    Stores each field of all structures concatenated in one tensor, so a batch
+    is gathered with one index_select per field instead of concatenating the
+    tensors of each structure in collate_nl.
+
+    The dataset is indexed with a list of structure indices and returns the
+    batch in the same format as collate_nl. It is therefore used with a
+    BatchSampler, automatic batching disabled and an identity collate_fn.
+    Fields that are part of an autograd graph, like the direction vectors,
+    cannot share one concatenated tensor between batches, so they are still
+    concatenated with one torch.concatenate per batch in ``__getitem__``.
+
+    >>> from ase.build import molecule
+    >>> from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
+    >>> from torch_spex.structures import BatchedInMemoryDataset, TransformerNeighborList
+    >>> transformers = [TransformerNeighborList(cutoff=3)]
+    >>> dataset = BatchedInMemoryDataset([molecule("H2O"), molecule("CH4")], transformers)
+    >>> sampler = BatchSampler(SequentialSampler(dataset), batch_size=2, drop_last=False)
+    >>> loader = DataLoader(dataset, sampler=sampler, batch_size=None, collate_fn=lambda batch: batch)
+    >>> batch = next(iter(loader))
+    >>> batch["structure_centers"]
+    tensor([0, 0, 0, 1, 1, 1, 1, 1])
+    """
+    def __init__(self,
+                 structures : List[AtomicStructure],
+                 transformers : List[TransformerBase]):
+        super().__init__()
+        self.n_structures = len(structures)
+        data = _transform_structures(structures, transformers)
+
+        # positions and cell are kept per structure, because they need to stay
+        # leaf nodes to compute gradients with respect to them (see collate_nl).
+        # Fields with autograd history, like the direction vectors, are also kept
+        # per structure and only concatenated for the selected structures. A
+        # tensor concatenated over the whole dataset would share one graph between
+        # all batches, so a backward pass on one batch would free the saved
+        # tensors needed by the next one.
+        self._per_structure_data = {}
+        self._per_structure_concatenated_data = {}
+        self._data = {}
+        self._offsets = {}
+        self._lengths = {}
+        for key, values in data.items():
+            if key in ["positions", "cell"]:
+                self._per_structure_data[key] = values
+            elif any(value.requires_grad for value in values):
+                self._per_structure_concatenated_data[key] = values
+            else:
+                lengths = torch.tensor([len(value) for value in values])
+                self._data[key] = torch.concatenate(values, dim=0)
+                self._lengths[key] = lengths
+                self._offsets[key] = lengths.cumsum(0) - lengths
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices).reshape(-1)
+        batch = {}
+        for key, values in self._data.items():
+            lengths = self._lengths[key][indices]
+            starts = self._offsets[key][indices]
+            # index of each element of the selected structures in the concatenated tensor
+            flat_idx = torch.repeat_interleave(starts - (lengths.cumsum(0) - lengths), lengths) + torch.arange(int(lengths.sum()))
+            batch[key] = values.index_select(0, flat_idx.to(values.device))
+        for key, values in self._per_structure_data.items():
+            batch[key] = [values[idx] for idx in indices.tolist()]
+        for key, values in self._per_structure_concatenated_data.items():
+            batch[key] = torch.concatenate([values[idx] for idx in indices.tolist()], dim=0)
+        if "structure_centers" in batch:
+            _rebase_structure_indices(batch)
+        if "pairs" in batch:
+            batch['pairs_offset'] = get_pairs_offset(self._lengths["centers"][indices], self._lengths["pairs"][indices])
+        return batch
+
+    def __len__(self):
+        return self.n_structures
+
+def get_pairs_offset(n_centers_per_structure: torch.Tensor, n_pairs_per_structure: torch.Tensor) -> torch.Tensor:
+    """
+    Computes for each pair the offset of the atoms of its structure in the
+    batch, such that `pairs + pairs_offset[:, None]` indexes the batched atoms.
+
+    :param n_centers_per_structure: [n_structures] tensor with the number of
+            atoms of each structure in the batch
+    :param n_pairs_per_structure: [n_structures] tensor with the number of
+            pairs of each structure in the batch
+
+    :returns pairs_offset: [n_pairs] tensor of integers
+    """
+    centers_offsets_per_structure = n_centers_per_structure.cumsum(0) - n_centers_per_structure
+    return torch.repeat_interleave(centers_offsets_per_structure, n_pairs_per_structure)
+
 def collate_nl(data_list):
+    # The offsets of the atoms of each structure in the batch are computed here
+    # once and passed as pairs_offset, so the expansions do not need to recover
+    # them from structure_centers and structure_pairs in every forward call.
+    #
     # positions may not be stacked because we need them as leaf nodes to get gradients
     # because concatenating or slicing creates a new node in the autograd graph
     #
@@ -140,7 +262,9 @@ def collate_nl(data_list):
     collated = {key: torch.concatenate([data[key] for data in data_list], dim=0) for key in filter(lambda x : x not in ["positions", "cell"], data_list[0].keys())}
     collated['positions'] = [data["positions"] for data in data_list]
     collated['cell'] = [data["cell"] for data in data_list]
-    min_structure_idx = collated['structure_centers'][0].clone()
-    collated['structure_centers'] -= min_structure_idx # minimum structure index should be first one
-    collated['structure_pairs'] -= min_structure_idx # minimum structure index should be first one
+    _rebase_structure_indices(collated)
+    collated['pairs_offset'] = get_pairs_offset(
+        torch.tensor([len(data["centers"]) for data in data_list]),
+        torch.tensor([len(data["pairs"]) for data in data_list])
+    )
     return collated